@@ -5,34 +5,139 @@ Improved implementation with better error handling and connection management
 """
 
 import asyncio
+import hmac
+import numpy as np
 import websockets
-import json
-import base64
+import orjson
+import pybase64
 import logging
+import re
+import socket
+import sys
 from typing import Optional
 import traceback
-from websockets.exceptions import InvalidUpgrade, ConnectionClosed
+from websockets.exceptions import InvalidUpgrade, ConnectionClosed, ConnectionClosedOK
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class MaqsamVoiceAgent:
+# Fast path for audio.input frames: pull data.audio out without building a dict
+AUDIO_INPUT_MARKER = b'"type":"audio.input"'
+AUDIO_PAYLOAD_RE = re.compile(rb'"audio"\s*:\s*"([^"]*)"')
+
+# Subprotocol under which audio travels as raw mulaw in binary frames instead
+# of base64 inside JSON; control messages stay JSON text frames
+BINARY_AUDIO_SUBPROTOCOL = "maqsam.audio.mulaw"
+
+# Busy-poll the NIC queue for this long (microseconds) on socket reads instead
+# of waiting for the interrupt coalescing timer. Linux only; not exposed by the
+# socket module, so fall back to the value from <asm-generic/socket.h>
+BUSY_POLL_USEC = 50
+SO_BUSY_POLL = getattr(socket, "SO_BUSY_POLL", 46)
+# Larger kernel send buffer so bursts of response audio don't stall on drain
+SEND_BUFFER_SIZE = 262144
+# Upper bound on audio coalesced into one response frame (1 s of 8 kHz mulaw)
+AUDIO_COALESCE_MAX_BYTES = 8000
+
+def create_listen_socket(host: str, port: int, reuse_port: bool = False) -> socket.socket:
+    """
+    Create the listening socket for websockets.serve(sock=...)
+    Options set here are inherited by every accepted connection
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    if reuse_port:
+        # Only for running several server processes on one port. Otherwise a stray
+        # second instance would silently take half the calls instead of failing
+        # with EADDRINUSE
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if sys.platform.startswith("linux"):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, BUSY_POLL_USEC)
+        except OSError as e:
+            # Raising busy-poll above net.core.busy_read needs CAP_NET_ADMIN
+            logger.warning(f"Could not enable SO_BUSY_POLL: {e}")
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+def mulaw_to_linear(value: int) -> int:
+    """Decode one G.711 mulaw byte to a 16-bit linear PCM sample"""
+    value = ~value & 0xFF
+    sample = (((value & 0x0F) << 3) + 0x84) << ((value >> 4) & 0x07)
+    sample -= 0x84
+    return -sample if value & 0x80 else sample
+
+# mulaw -> int16 PCM lookup table, so decoding a frame is a single gather
+_MULAW_LUT = np.array([mulaw_to_linear(i) for i in range(256)], dtype=np.int16)
+
+def select_subprotocol(connection, subprotocols):
+    """Opt into binary audio framing only when the client offers it"""
+    if BINARY_AUDIO_SUBPROTOCOL in subprotocols:
+        return BINARY_AUDIO_SUBPROTOCOL
+    return None
+
+# Constant control frames, serialized once and shared by every session
+MSG_SESSION_READY = b'{"type":"session.ready"}'
+MSG_SPEECH_STARTED = b'{"type":"speech.started"}'
+MSG_CALL_REDIRECT = b'{"type":"call.redirect"}'
+MSG_CALL_HANGUP = b'{"type":"call.hangup"}'
+# response.stream frame template; base64 never needs JSON escaping
+RESP_PREFIX = b'{"type":"response.stream","data":{"audio":"'
+RESP_SUFFIX = b'"}}'
+
+class MaqsamServer:
+    """Configuration shared by all calls; runs each connection in its own MaqsamSession"""
+    __slots__ = ('_auth_token',)
+
     def __init__(self, auth_token: str):
-        self.auth_token = auth_token
-        self.websocket = None
+        self._auth_token = auth_token.encode()
+        
+    def token_matches(self, token) -> bool:
+        """Constant-time comparison of a client-supplied token"""
+        return isinstance(token, str) and hmac.compare_digest(token.encode(), self._auth_token)
+    
+    async def handle(self, websocket):
+        """websockets.serve handler - one session per call, so calls never share state"""
+        await MaqsamSession(self, websocket).run()
+
+class MaqsamSession:
+    """Per-connection state for a single Maqsam call"""
+    __slots__ = (
+        'server', 'websocket', '_send', 'call_context', 'binary_audio',
+        '_audio_queue', '_audio_writer', '_handlers',
+    )
+
+    def __init__(self, server: MaqsamServer, websocket):
+        self.server = server
+        self.websocket = websocket
+        self._send = websocket.send
         self.call_context = None
-        self.heartbeat_task = None
+        self.binary_audio = websocket.subprotocol == BINARY_AUDIO_SUBPROTOCOL
+        self._audio_queue = asyncio.Queue()
+        self._audio_writer = None
+        self._handlers = {
+            'session.setup': self._on_session_setup,
+            'audio.input': self._on_audio_input,
+        }
         
-    async def authenticate_connection(self, websocket, path):
+    async def authenticate_connection(self):
         """
         Handle authentication - checking for Auth header in request
         """
         try:
-            auth_header = websocket.request.headers.get('Auth') or websocket.request.headers.get('Authorization')
-            if auth_header != self.auth_token:
+            request_headers = self.websocket.request.headers
+            auth_header = request_headers.get('Auth') or request_headers.get('Authorization')
+            if not self.server.token_matches(auth_header):
                 logger.warning(f"Authentication failed - invalid or missing Auth header. Received: {auth_header}")
-                await websocket.close(code=1008, reason="Unauthorized")
+                await self.websocket.close(code=1008, reason="Unauthorized")
                 return False
             logger.info("Authentication successful via HTTP Auth Header")
             return True
@@ -46,7 +151,7 @@ class MaqsamVoiceAgent:
         """
         try:
             api_key = message_data.get('apiKey')
-            if api_key and api_key != self.auth_token:
+            if api_key and not self.server.token_matches(api_key):
                 logger.warning("WebSocket token authentication failed")
                 return False
             self.call_context = message_data.get('data', {}).get('context', {})
@@ -59,42 +164,108 @@ class MaqsamVoiceAgent:
             logger.error(f"Error in session setup: {e}")
             return False
     
+    async def _on_session_setup(self, data):
+        """
+        Dispatch session.setup; confirm with session.ready or close the connection
+        Returns False when the connection was closed and the session must stop
+        """
+        if await self.handle_session_setup(data):
+            logger.info("Session setup completed successfully")
+            # Send session.ready AFTER successful session setup
+            await self.send_session_ready()
+            return True
+        await self.websocket.close(code=1002, reason="Session setup failed")
+        return False
+    
     async def send_session_ready(self):
         """Send session ready confirmation to Maqsam"""
         try:
-            ready_message = {"type": "session.ready"}
-            await self.websocket.send(json.dumps(ready_message))
+            await self._send(MSG_SESSION_READY, text=True)
             logger.info("Sent session.ready confirmation")
         except Exception as e:
             logger.error(f"Error sending session.ready: {e}")
             raise
     
-    async def handle_audio_input(self, message_data):
+    async def handle_audio_input(self, audio_data, raw=False):
         """
         Process incoming audio from customer
-        Audio format: Base64 encoded mulaw, 8000 sample rate
+        Audio format: mulaw, 8000 sample rate; base64 encoded unless raw
         """
         try:
-            audio_data = message_data.get('data', {}).get('audio', '')
-            logger.info(f"Received audio input: {len(audio_data)} bytes (base64)")
-            await self.generate_ai_response()
+            if not raw:
+                audio_data = pybase64.b64decode(audio_data, validate=False)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received audio input: %d bytes (mulaw)", len(audio_data))
+            pcm = _MULAW_LUT[np.frombuffer(audio_data, dtype=np.uint8)]
+            await self.generate_ai_response(pcm)
         except Exception as e:
             logger.error(f"Error handling audio input: {e}")
     
-    async def send_audio_response(self, audio_base64: str):
-        """Send AI voice response back to customer"""
+    async def _on_audio_input(self, data):
+        """Dispatch audio.input messages that missed the byte-level fast path"""
         try:
-            response_message = {"type": "response.stream", "data": {"audio": audio_base64}}
-            await self.websocket.send(json.dumps(response_message))
-            logger.info(f"Sent audio response: {len(audio_base64)} bytes (base64)")
+            audio_data = data['data']['audio']
+        except KeyError:
+            audio_data = b''
+        await self.handle_audio_input(audio_data)
+        return True
+    
+    async def send_audio_response(self, audio: bytes):
+        """Queue AI voice response (raw mulaw) for the audio writer"""
+        if self._audio_writer.done():
+            return  # Peer is gone; nothing will ever send this
+        self._audio_queue.put_nowait(audio)
+    
+    def _discard_queued_audio(self):
+        """Drop response audio that has not been handed to the writer yet"""
+        queue = self._audio_queue
+        while not queue.empty():
+            queue.get_nowait()
+            queue.task_done()
+    
+    async def audio_writer_loop(self):
+        """Write queued response audio, coalescing chunks that are already waiting into one frame"""
+        queue = self._audio_queue
+        while True:
+            chunks = [await queue.get()]
+            size = len(chunks[0])
+            while size < AUDIO_COALESCE_MAX_BYTES and not queue.empty():
+                chunk = queue.get_nowait()
+                chunks.append(chunk)
+                size += len(chunk)
+            try:
+                await self._write_audio(chunks[0] if len(chunks) == 1 else b''.join(chunks))
+            except ConnectionClosed:
+                logger.debug("Connection closed, stopping audio writer")
+                self._discard_queued_audio()
+                return
+            finally:
+                for _ in chunks:
+                    queue.task_done()
+    
+    async def _write_audio(self, audio: bytes):
+        """Send one response audio frame"""
+        try:
+            if self.binary_audio:
+                await self._send(audio)
+            else:
+                await self._send(
+                    RESP_PREFIX + pybase64.b64encode(audio) + RESP_SUFFIX,
+                    text=True,
+                )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Sent audio response: %d bytes (mulaw)", len(audio))
+        except ConnectionClosed:
+            raise
         except Exception as e:
             logger.error(f"Error sending audio response: {e}")
     
     async def send_speech_started(self):
         """Notify Maqsam that customer started speaking (interruption handling)"""
         try:
-            speech_message = {"type": "speech.started"}
-            await self.websocket.send(json.dumps(speech_message))
+            # The customer barged in, so cut off agent audio that hasn't gone out yet
+            self._discard_queued_audio()
+            await self._send(MSG_SPEECH_STARTED, text=True)
             logger.info("Sent speech.started (customer interruption)")
         except Exception as e:
             logger.error(f"Error sending speech.started: {e}")
@@ -102,8 +273,8 @@ class MaqsamVoiceAgent:
     async def send_call_redirect(self):
         """Redirect call to human agent"""
         try:
-            redirect_message = {"type": "call.redirect"}
-            await self.websocket.send(json.dumps(redirect_message))
+            await self._audio_queue.join()  # Let queued audio play out first
+            await self._send(MSG_CALL_REDIRECT, text=True)
             logger.info("Redirecting call to human agent")
         except Exception as e:
             logger.error(f"Error redirecting call: {e}")
@@ -111,105 +282,92 @@ class MaqsamVoiceAgent:
     async def send_call_hangup(self):
         """End the call gracefully"""
         try:
-            hangup_message = {"type": "call.hangup"}
-            await self.websocket.send(json.dumps(hangup_message))
+            await self._audio_queue.join()  # Let queued audio play out first
+            await self._send(MSG_CALL_HANGUP, text=True)
             logger.info("Ending call")
         except Exception as e:
             logger.error(f"Error hanging up call: {e}")
     
-    async def generate_ai_response(self):
-        """Placeholder for AI response generation"""
-        logger.info("TODO: Generate AI response based on customer input")
-    
-    async def start_heartbeat(self):
-        """Start heartbeat to keep connection alive"""
-        self.heartbeat_task = asyncio.create_task(self.heartbeat_loop())
-    
-    async def heartbeat_loop(self):
-        """Send periodic ping to keep connection alive"""
-        try:
-            while True:
-                await asyncio.sleep(30)  # Send heartbeat every 30 seconds
-                if self.websocket and not self.websocket.closed:
-                    try:
-                        await self.websocket.ping()
-                        logger.debug("Sent heartbeat ping")
-                    except Exception as e:
-                        logger.warning(f"Heartbeat failed: {e}")
-                        break
-                else:
-                    break
-        except asyncio.CancelledError:
-            logger.debug("Heartbeat task cancelled")
-        except Exception as e:
-            logger.error(f"Error in heartbeat loop: {e}")
-    
-    async def stop_heartbeat(self):
-        """Stop heartbeat task"""
-        if self.heartbeat_task:
-            self.heartbeat_task.cancel()
-            try:
-                await self.heartbeat_task
-            except asyncio.CancelledError:
-                pass
-            self.heartbeat_task = None
+    async def generate_ai_response(self, pcm):
+        """Placeholder for AI response generation (pcm: int16 samples at 8 kHz)"""
+        logger.debug("TODO: Generate AI response based on customer input")
     
-    async def handle_connection(self, websocket, path=None):
+    async def run(self):
         """Main WebSocket connection handler"""
-        self.websocket = websocket
+        websocket = self.websocket
         client_info = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}" if websocket.remote_address else "unknown"
         logger.info(f"New connection from {client_info}")
         
-        if not await self.authenticate_connection(websocket, path):
+        if not await self.authenticate_connection():
             return
         
+        self._audio_writer = asyncio.create_task(self.audio_writer_loop())
+        
         try:
-            # Start heartbeat to keep connection alive
-            await self.start_heartbeat()
+            # Keepalive is handled by websockets.serve(ping_interval=..., ping_timeout=...)
             # DON'T send session.ready immediately - wait for session.setup first
             logger.info("Waiting for session.setup message from Maqsam...")
             
-            async for message in websocket:
-                logger.debug(f"Received raw message: {message}")
+            # Without binary audio every frame is ASCII JSON, so receive text frames
+            # as bytes and skip UTF-8 decoding; with it, str vs bytes tells control
+            # messages from audio
+            decode = None if self.binary_audio else False
+            while True:
+                message = await websocket.recv(decode)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Received raw message: %s", message)
                 if not message:  # Handle empty messages
                     logger.debug("Received empty message, continuing to wait")
                     continue
                 
                 try:
-                    data = json.loads(message)
+                    if isinstance(message, bytes):
+                        if self.binary_audio:
+                            await self.handle_audio_input(message, raw=True)
+                            continue
+                        if AUDIO_INPUT_MARKER in message:
+                            match = AUDIO_PAYLOAD_RE.search(message)
+                            if match:
+                                # Slice the payload out of the frame without copying it
+                                start, end = match.span(1)
+                                await self.handle_audio_input(memoryview(message)[start:end])
+                                continue
+                    
+                    data = orjson.loads(message)
                     message_type = data.get('type')
-                    logger.info(f"Processing message type: {message_type}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Processing message type: %s", message_type)
                     
-                    if message_type == 'session.setup':
-                        if await self.handle_session_setup(data):
-                            logger.info("Session setup completed successfully")
-                            # Send session.ready AFTER successful session setup
-                            await self.send_session_ready()
-                        else:
-                            await websocket.close(code=1002, reason="Session setup failed")
+                    handler = self._handlers.get(message_type)
+                    if handler is not None:
+                        # Handlers return False once they have closed the connection;
+                        # stop immediately so frames already buffered are not processed
+                        if not await handler(data):
                             return
-                    elif message_type == 'audio.input':
-                        await self.handle_audio_input(data)
                     else:
                         logger.warning(f"Unknown message type: {message_type}")
                         
-                except json.JSONDecodeError as e:
+                except orjson.JSONDecodeError as e:
                     logger.error(f"Failed to parse JSON message: {message}. Error: {e}")
                     await websocket.close(code=1002, reason="Invalid JSON")
                     return
-                except Exception as e:
-                    logger.error(f"Error processing message: {e}")
-                    logger.error(f"Traceback: {traceback.format_exc()}")
+                except Exception:
+                    logger.exception("Error processing message")
                     
+        except ConnectionClosedOK:
+            pass  # Normal end of call
         except ConnectionClosed as e:
             logger.info(f"WebSocket connection closed: {e.code} - {e.reason}")
         except Exception as e:
             logger.error(f"Unexpected error in WebSocket handler: {e}")
             logger.error(f"Traceback: {traceback.format_exc()}")
         finally:
-            await self.stop_heartbeat()
-            self.websocket = None
-            self.call_context = None
+            self._audio_writer.cancel()
+            try:
+                await self._audio_writer
+            except asyncio.CancelledError:
+                pass
+            self._discard_queued_audio()  # Don't leave redirect/hangup waiting on join()
             logger.info(f"Connection cleanup completed for {client_info}")
 
 async def main():
@@ -217,9 +375,10 @@ async def main():
     Start the WebSocket server with improved error handling
     """
     AUTH_TOKEN = "2BUrGJJPmN7WvNzEtDmD"
-    voice_agent = MaqsamVoiceAgent(AUTH_TOKEN)
+    voice_server = MaqsamServer(AUTH_TOKEN)
     HOST = "0.0.0.0"
     PORT = 8080
+    REUSE_PORT = False  # Set when running several server processes on PORT
     
     logger.info(f"Starting Maqsam Voice Agent WebSocket server on {HOST}:{PORT}")
     logger.info("Using Cloudflare SSL termination")
@@ -228,9 +387,9 @@ async def main():
     try:
         # Start server without process_request to avoid HTTP handling issues
         server = await websockets.serve(
-            voice_agent.handle_connection,
-            HOST,
-            PORT,
+            voice_server.handle,
+            sock=create_listen_socket(HOST, PORT, reuse_port=REUSE_PORT),
+            select_subprotocol=select_subprotocol,
             ping_interval=30,  # Send ping every 30 seconds
             ping_timeout=10,   # Wait 10 seconds for pong response
             close_timeout=10   # Wait 10 seconds when closing
@@ -245,7 +404,10 @@ async def main():
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Server stopped by user")
     except Exception as e: